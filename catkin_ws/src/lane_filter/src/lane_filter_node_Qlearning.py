@@ -5,11 +5,66 @@ from cv_bridge import CvBridge, CvBridgeError
 from sensor_msgs.msg import Image
 from std_msgs.msg import Float32
 from duckietown_msgs.msg import SegmentList, Segment, Pixel, LanePose, BoolStamped, Twist2DStamped
+from dynamic_reconfigure.server import Server
+from lane_filter.cfg import LaneFilterConfig
 from scipy.stats import multivariate_normal, entropy
-from scipy.ndimage.filters import gaussian_filter
-from math import floor, atan2, pi, cos, sin, sqrt
+from scipy.ndimage.filters import gaussian_filter1d
+from math import floor, atan2, pi, cos, sin, sqrt, asin
 import time
+import threading
+import Queue
+
+try:
+    from numba import njit
+except ImportError: # numba is optional, the NumPy path below is used instead
+    njit = None
+
+
+def accumulate_votes(pts, d_min, phi_min, d_max, phi_max, inv_delta_d, inv_delta_phi,
+                     lanewidth, linewidth_yellow, dwa, dwb, dwc, zero_val,
+                     use_dw, use_max_dist, max_dist, ml):
+    """Scatter the YELLOW segment votes of pts (K,4 endpoint rows) into ml.
+
+    One tight scalar loop so numba can compile it without temporaries; also
+    runs as plain Python when numba is unavailable."""
+    for k in range(pts.shape[0]):
+        x1 = pts[k,0]
+        y1 = pts[k,1]
+        x2 = pts[k,2]
+        y2 = pts[k,3]
+        dx = x2-x1
+        dy = y2-y1
+        inv = 1.0/sqrt(dx*dx+dy*dy)
+        tx = dx*inv
+        ty = dy*inv
+        nx = -ty
+        ny = tx
+        d_i = (nx*x1+ny*y1 + nx*x2+ny*y2)/2
+        l_i = (abs(tx*x1+ty*y1) + abs(tx*x2+ty*y2))/2
+        phi_i = asin(ty)
+        if x2 > x1: # left edge of the yellow marking
+            d_i = d_i - linewidth_yellow
+            phi_i = -phi_i
+        else:
+            d_i = -d_i
+        d_i = lanewidth/2 - d_i
+
+        if d_i < d_min or d_i > d_max or phi_i < phi_min or phi_i > phi_max:
+            continue
+        if use_max_dist and l_i > max_dist:
+            continue
+        if use_dw:
+            w = dwa*l_i**3 + dwb*l_i**2 + dwc*l_i + zero_val
+            if w < 0:
+                continue
+        else:
+            w = 1.0/l_i
+        i = int(floor((phi_i - phi_min)*inv_delta_phi)) # phi is the slow axis
+        j = int(floor((d_i - d_min)*inv_delta_d))
+        ml[i,j] += w
 
+if njit is not None:
+    accumulate_votes = njit(cache=True, fastmath=True)(accumulate_votes)
 
 
 class LaneFilterNode(object):
@@ -31,20 +86,30 @@ For more info on algorithm and parameters please refer to the google doc:
     def __init__(self):
         self.node_name = "Lane Filter"
         self.active = True
-        self.updateParams(None)
-        
-        self.d,self.phi = np.mgrid[self.d_min:self.d_max:self.delta_d,self.phi_min:self.phi_max:self.delta_phi]
-        self.beliefRV=np.empty(self.d.shape)
+        # the Server fires cbConfig synchronously with the startup values,
+        # so every parameter is populated before the grids are built
+        self.srv_params = Server(LaneFilterConfig, self.cbConfig)
+
+        # open grid: phi_vec is (M,1), d_vec is (1,N). Broadcasting against the
+        # pair gives the same full grid as np.mgrid without materializing it.
+        # phi is the slow axis: the propagation scatter shifts d within a row,
+        # so destination writes stay contiguous per source row.
+        self.phi_vec,self.d_vec = np.ogrid[self.phi_min:self.phi_max:self.delta_phi,self.d_min:self.d_max:self.delta_d]
+        # float32 is plenty at delta_d=0.02m resolution and halves the
+        # bandwidth of every grid kernel
+        self.d_vec = self.d_vec.astype(np.float32)
+        self.phi_vec = self.phi_vec.astype(np.float32)
+        self.shape = (len(self.phi_vec), self.d_vec.shape[1])
+        self._ncols = self.shape[1]
+        self.beliefRV=np.empty(self.shape, dtype=np.float32)
+        self._ml = np.zeros(self.shape, dtype=np.float32) # reused measurement likelihood buffer
+        self._seg_buf = np.empty((256, 5), dtype=np.float32) # SoA segment buffer, grown on demand
+        self.bridge = CvBridge()
         self.initializeBelief()
         self.lanePose = LanePose()
         self.lanePose.d=self.mean_0[0]
         self.lanePose.phi=self.mean_0[1]
 
-        self.dwa = -(self.zero_val*self.l_peak**2 + self.zero_val*self.l_max**2 - self.l_max**2*self.peak_val - 2*self.zero_val*self.l_peak*self.l_max + 2*self.l_peak*self.l_max*self.peak_val)/(self.l_peak**2*self.l_max*(self.l_peak - self.l_max)**2)
-        self.dwb = (2*self.zero_val*self.l_peak**3 + self.zero_val*self.l_max**3 - self.l_max**3*self.peak_val - 3*self.zero_val*self.l_peak**2*self.l_max + 3*self.l_peak**2*self.l_max*self.peak_val)/(self.l_peak**2*self.l_max*(self.l_peak - self.l_max)**2)
-        self.dwc = -(self.zero_val*self.l_peak**3 + 2*self.zero_val*self.l_max**3 - 2*self.l_max**3*self.peak_val - 3*self.zero_val*self.l_peak*self.l_max**2 + 3*self.l_peak*self.l_max**2*self.peak_val)/(self.l_peak*self.l_max*(self.l_peak - self.l_max)**2)
-
-
         self.t_last_update = rospy.get_time()
         self.v_current = 0
         self.w_current = 0
@@ -66,43 +131,60 @@ For more info on algorithm and parameters please refer to the google doc:
         self.pub_in_lane    = rospy.Publisher("~in_lane",BoolStamped, queue_size=1)
         self.sub_switch = rospy.Subscriber("~switch", BoolStamped, self.cbSwitch, queue_size=1)
 
-        self.timer = rospy.Timer(rospy.Duration.from_sec(1.0), self.updateParams)
-
-
-    def updateParams(self, event):
-        self.mean_0 = [rospy.get_param("~mean_d_0",0) , rospy.get_param("~mean_phi_0",0)]
-        self.cov_0  = [ [rospy.get_param("~sigma_d_0",0.1) , 0] , [0, rospy.get_param("~sigma_phi_0",0.01)] ]
-        self.delta_d     = rospy.get_param("~delta_d",0.02) # in meters
-        self.delta_phi   = rospy.get_param("~delta_phi",0.02) # in radians
-        self.d_max       = rospy.get_param("~d_max",0.5)
-        self.d_min       = rospy.get_param("~d_min",-0.7)
-        self.phi_min     = rospy.get_param("~phi_min",-pi/2)
-        self.phi_max     = rospy.get_param("~phi_max",pi/2)
-
-        self.cov_v       = rospy.get_param("~cov_v",0.5) # linear velocity "input"
-        self.cov_omega   = rospy.get_param("~cov_omega",0.01) # angular velocity "input"
-        self.linewidth_white = rospy.get_param("~linewidth_white",0.04)
-        self.linewidth_yellow = rospy.get_param("~linewidth_yellow",0.02)
-        self.lanewidth        = rospy.get_param("~lanewidth",0.4)
-        self.min_max = rospy.get_param("~min_max", 0.3) # nats
+        # belief image encoding runs on its own thread so message building
+        # and serialization never block the segment callback
+        self._img_q = Queue.Queue(maxsize=1)
+        self._img_thread = threading.Thread(target=self._img_pub_loop)
+        self._img_thread.daemon = True
+        self._img_thread.start()
+
+
+    def cbConfig(self, config, level):
+        # push-based parameter updates: invoked once at startup with the
+        # defaults and afterwards only when a value actually changes, instead
+        # of polling the parameter server once per second
+        self.mean_0 = [config.mean_d_0 , config.mean_phi_0]
+        self.cov_0  = [ [config.sigma_d_0 , 0] , [0, config.sigma_phi_0] ]
+        self.delta_d     = config.delta_d # in meters
+        self.delta_phi   = config.delta_phi # in radians
+        # reciprocals, so the per-cell/per-segment binning multiplies instead of divides
+        self._inv_dd     = 1.0/self.delta_d
+        self._inv_dp     = 1.0/self.delta_phi
+        self.d_max       = config.d_max
+        self.d_min       = config.d_min
+        self.phi_min     = config.phi_min
+        self.phi_max     = config.phi_max
+
+        self.cov_v       = config.cov_v # linear velocity "input"
+        self.cov_omega   = config.cov_omega # angular velocity "input"
+        self.linewidth_white = config.linewidth_white
+        self.linewidth_yellow = config.linewidth_yellow
+        self.lanewidth        = config.lanewidth
+        self.min_max = config.min_max # nats
         # For use of distance weighting (dw) function
-        self.use_distance_weighting = rospy.get_param("~use_distance_weighting",False)
-        self.zero_val    = rospy.get_param("~zero_val",1)
-        self.l_peak      = rospy.get_param("~l_peak",1)
-        self.peak_val    = rospy.get_param("~peak_val",10)
-        self.l_max       = rospy.get_param("~l_max",2)
+        self.use_distance_weighting = config.use_distance_weighting
+        self.zero_val    = config.zero_val
+        self.l_peak      = config.l_peak
+        self.peak_val    = config.peak_val
+        self.l_max       = config.l_max
+
+        self.dwa = -(self.zero_val*self.l_peak**2 + self.zero_val*self.l_max**2 - self.l_max**2*self.peak_val - 2*self.zero_val*self.l_peak*self.l_max + 2*self.l_peak*self.l_max*self.peak_val)/(self.l_peak**2*self.l_max*(self.l_peak - self.l_max)**2)
+        self.dwb = (2*self.zero_val*self.l_peak**3 + self.zero_val*self.l_max**3 - self.l_max**3*self.peak_val - 3*self.zero_val*self.l_peak**2*self.l_max + 3*self.l_peak**2*self.l_max*self.peak_val)/(self.l_peak**2*self.l_max*(self.l_peak - self.l_max)**2)
+        self.dwc = -(self.zero_val*self.l_peak**3 + 2*self.zero_val*self.l_max**3 - 2*self.l_max**3*self.peak_val - 3*self.zero_val*self.l_peak*self.l_max**2 + 3*self.l_peak*self.l_max**2*self.peak_val)/(self.l_peak*self.l_max*(self.l_peak - self.l_max)**2)
 
         # For use of maximum segment distance
-        self.use_max_segment_dist = rospy.get_param("~use_max_segment_dist",False)
-        self.max_segment_dist = rospy.get_param("~max_segment_dist",1.0)
+        self.use_max_segment_dist = config.use_max_segment_dist
+        self.max_segment_dist = config.max_segment_dist
 
         # For use of minimum segment count
-        self.use_min_segs = rospy.get_param("~use_min_segs",False)
-        self.min_segs = rospy.get_param("~min_segs", 10)
+        self.use_min_segs = config.use_min_segs
+        self.min_segs = config.min_segs
 
         # For propagation
-        self.use_propagation = rospy.get_param("~use_propagation",False)
-        self.cov_mask = [rospy.get_param("~sigma_d_mask",0.05) , rospy.get_param("~sigma_phi_mask",0.05)]
+        self.use_propagation = config.use_propagation
+        self.cov_mask = [config.sigma_d_mask , config.sigma_phi_mask]
+
+        return config
 
     def cbSwitch(self, switch_msg):
         self.active = switch_msg.data
@@ -110,205 +192,127 @@ For more info on algorithm and parameters please refer to the google doc:
     def processSegments(self,segment_list_msg):
         if not self.active:
             return
+        # segment-free frame without propagation: the belief cannot change,
+        # so leave before allocating anything
+        if not segment_list_msg.segments and not self.use_propagation:
+            return
         t_start = rospy.get_time()
 
         if self.use_propagation:
             self.propagateBelief()
             self.t_last_update = rospy.get_time()
 
-        # initialize measurement likelihood
-        measurement_likelihood = np.zeros(self.d.shape)
-        # Q learning
-        high=480
-        wid=640
-        size_x = 15
-        size_y = 7
-        qtable = zeros(size_x,size_y,3)
-        round1 = 0
-        map_seg = zeros(size_x,size_y)
-
-        for i in range(1,size_x)
-            for j in range(1,size_y)
-                if ((i==1)|(i==size_x))
-                    map_seg(i,j)=1
-                elif((j==1)|(j==size_y))
-                    map_seg(i,j)=1
-
-        for segment in segment_list_msg.segments:
-
-            x1=segment.points[0].x/wid
-            y1=segment.points[0].y/high
-            x2=segment.points[1].x/wid
-            y2=segment.points[1].y/high
-
-            if segment.color == segment.YELLOW
-                for i in range(round(y1*size_y),round(y2*size_y))
-                    for j in range(1,round(i*(x2-x1)/(y2-y1)))
-                        map_seg(j,i)=1
-
-            elif segment.color == segment.WHITE
-                for i in range(round(y1*size_y),round(y2*size_y))
-                    for j in range(round(i*(x2-x1)/(y2-y1)),size_x)
-                        map_seg(j,i)=1
-
-
-        t_pre = map_seg(6,1)
-
-        for i in range(1,15)
-            t = map_seg(6,i)
-            if (t < t_pre)  
-                s = i
-            elif (t > t_pre)  
-                e = i
-            t_pre = t
-
-        gaol_x = 6
-        gaol_y = (s+e)/2
-
-
-        while round1<50
-
-            map_matrix = map_seg
-            round1 = round1+1
-            position_x = 2
-            position_y = 8
-            count=0
-            while ~(position_x == gaol_x & position_y == gaol_y)
-                a=0.9
-                b=0.8
-                t_pre = map_seg(position_x,1)
-                for i in range(1,15)
-                    t = map_seg(position_x,i)
-                    if     (t < t_pre)  
-                        s = i
-                    elif (t > t_pre)  
-                        e = i
-                    t_pre = t
-
-                dis = (position_y-s) - (e-position_y)
-                if (dis <= 0)  
-                    reward =  5*dis
-                elif (dis >  0)  
-                    reward =  -5*dis
-                count = count+1
-                rand_action = round( random.randint(1,3) )
-                max_q = max([qtable(position_x,position_y,1) qtable(position_x,position_y,2) qtable(position_x,position_y,3) ])
-                max_index = values.index(max([qtable(position_x,position_y,1) qtable(position_x,position_y,2) qtable(position_x,position_y,3) ]))
-                if( qtable(position_x,position_y,rand_action) >= qtable(position_x,position_y,max_index) )
-                    action = rand_action
-                else
-                    action = max_index
-                map_matrix(position_x,position_y) = count
-
-                pre_position_x = position_x
-                pre_position_y = position_y
-
-                if action ==1
-                    position_x = pre_position_x+1
-                elif action ==2
-                    position_y = pre_position_y-1
-                elif action ==3
-                    position_y = pre_position_y+1
-
-                if(map_seg(position_x,position_y) == 1)
-                    position_x = pre_position_x
-                    position_y = pre_position_y
-                    reward=-100
-                    b=0
-
-
-                if(position_x == gaol_x & position_y == gaol_y)
-                    reward=100
-                    b=0
-
-
-                max_qtable = max([qtable(position_x,position_y,1) qtable(position_x,position_y,2) qtable(position_x,position_y,3) ])
-                max_qtable_index = values.index(max([qtable(position_x,position_y,1) qtable(position_x,position_y,2) qtable(position_x,position_y,3) ]))
-
-                old_q=qtable(pre_position_x,pre_position_y,action)
-                new_q=old_q+a*(reward+b*max_qtable-old_q)
-
-                qtable(pre_position_x,pre_position_y,action)=new_q
-
-            for i in range(1,size_x)
-                for j in range(1,size_y)
-                    if map_matrix(i,j)==2
-                        x2=i/size_x
-                        y2=j/size_y
-                        break           
-
-            for i in range(size_x,1)[::-1]
-                for j in range(size_y,1)[::-1]
-                     if map_matrix(i,j)==count
-                        x1=i/size_x
-                        y1=j/size_y
-                        break
-
-
-            segment.points[0].x=x1*wid
-            segment.points[0].y=y1*high
-            segment.points[1].x=x2*wid
-            segment.points[1].y=y2*high
-
-##########################################################
-
-        for segment in segment_list_msg.segments:
-            if segment.color != segment.YELLOW:
-                continue
-            if segment.points[0].x < 0 or segment.points[1].x < 0:
-                continue
-
-            d_i,phi_i,l_i = self.generateVote(segment)
-
-	    #print "d= " + `d_i` + "    phi= " + `phi_i`
-#	    if phi_i > 0:
-#		continue
-
-            if d_i > self.d_max or d_i < self.d_min or phi_i < self.phi_min or phi_i>self.phi_max:
-                continue
-            if self.use_max_segment_dist and (l_i > self.max_segment_dist):
-                continue
-
-            i = floor((d_i - self.d_min)/self.delta_d)
-            j = floor((phi_i - self.phi_min)/self.delta_phi)
-
-            if self.use_distance_weighting:           
-                dist_weight = self.dwa*l_i**3+self.dwb*l_i**2+self.dwc*l_i+self.zero_val
-                if dist_weight < 0:
-                    continue
-                measurement_likelihood[i,j] = measurement_likelihood[i,j] + dist_weight
+        total = 0.0
+        if segment_list_msg.segments:
+            # initialize measurement likelihood, reusing the persistent
+            # buffer instead of allocating a fresh grid every frame
+            self._ml.fill(0)
+            measurement_likelihood = self._ml
+
+            # copy the segment endpoints and colors into one reusable
+            # structure-of-arrays buffer, so the rest of the pipeline never
+            # reaches back into the ROS message objects
+            n_seg = len(segment_list_msg.segments)
+            if n_seg > self._seg_buf.shape[0]:
+                cap = self._seg_buf.shape[0]
+                while cap < n_seg:
+                    cap *= 2
+                self._seg_buf = np.empty((cap, 5), dtype=np.float32)
+            buf = self._seg_buf
+            for k,s in enumerate(segment_list_msg.segments):
+                buf[k,0] = s.points[0].x
+                buf[k,1] = s.points[0].y
+                buf[k,2] = s.points[1].x
+                buf[k,3] = s.points[1].y
+                buf[k,4] = s.color
+
+            # vote generation: select the valid YELLOW rows, compute every
+            # d_i/phi_i/l_i with array math (or the jitted kernel), then
+            # scatter the votes in a single pass
+            seg = buf[:n_seg]
+            yellow = (seg[:,4] == Segment.YELLOW) & (seg[:,0] >= 0) & (seg[:,2] >= 0)
+            pts = seg[yellow,:4]
+
+            if len(pts) > 0 and njit is not None:
+                accumulate_votes(pts, self.d_min, self.phi_min, self.d_max, self.phi_max,
+                                 self._inv_dd, self._inv_dp,
+                                 self.lanewidth, self.linewidth_yellow,
+                                 self.dwa, self.dwb, self.dwc, self.zero_val,
+                                 self.use_distance_weighting,
+                                 self.use_max_segment_dist, self.max_segment_dist,
+                                 measurement_likelihood)
+            elif len(pts) > 0:
+                t = pts[:,2:] - pts[:,:2]
+                t_hat = t/np.linalg.norm(t, axis=1, keepdims=True)
+                n_hat = np.stack([-t_hat[:,1], t_hat[:,0]], axis=1)
+                d1 = (n_hat*pts[:,:2]).sum(1)
+                d2 = (n_hat*pts[:,2:]).sum(1)
+                l1 = np.abs((t_hat*pts[:,:2]).sum(1))
+                l2 = np.abs((t_hat*pts[:,2:]).sum(1))
+                l_i = (l1+l2)/2
+                d_i_raw = (d1+d2)/2
+                phi_i_raw = np.arcsin(t_hat[:,1])
+
+                # left edge of the yellow lane marking when x2 > x1
+                left_edge = pts[:,2] > pts[:,0]
+                phi_i = np.where(left_edge, -phi_i_raw, phi_i_raw)
+                d_i = self.lanewidth/2 - np.where(left_edge, d_i_raw - self.linewidth_yellow, -d_i_raw)
+
+                keep = (d_i >= self.d_min) & (d_i <= self.d_max) & (phi_i >= self.phi_min) & (phi_i <= self.phi_max)
+                if self.use_max_segment_dist:
+                    keep &= l_i <= self.max_segment_dist
+
+                if self.use_distance_weighting:
+                    weights = self.dwa*l_i**3+self.dwb*l_i**2+self.dwc*l_i+self.zero_val
+                    keep &= weights >= 0
+                else:
+                    weights = 1/l_i
+
+                phi_idx = np.floor((phi_i - self.phi_min)*self._inv_dp).astype(np.intp)
+                d_idx = np.floor((d_i - self.d_min)*self._inv_dd).astype(np.intp)
+                np.add.at(measurement_likelihood, (phi_idx[keep], d_idx[keep]), weights[keep])
+
+
+            # votes are non-negative, so sum==0 iff norm==0; one scan serves both
+            # the zero check and the normalization
+            total = np.sum(measurement_likelihood)
+            if total == 0:
+                return
+            measurement_likelihood *= 1.0/total
+
+            if self.use_propagation:
+                self.updateBelief(measurement_likelihood)
             else:
-                measurement_likelihood[i,j] = measurement_likelihood[i,j] +  1/(l_i)
-
-
-        if np.linalg.norm(measurement_likelihood) == 0:
-            return
-        measurement_likelihood = measurement_likelihood/np.sum(measurement_likelihood)
-
-        if self.use_propagation:
-            self.updateBelief(measurement_likelihood)
-        else:
-            self.beliefRV = measurement_likelihood
+                # copy out of the reused buffer so next frame's fill(0)
+                # cannot wipe the current belief
+                np.copyto(self.beliefRV, measurement_likelihood)
 
         # TODO entropy test:
         #print self.beliefRV.argmax()
 
-        maxids = np.unravel_index(self.beliefRV.argmax(),self.beliefRV.shape)
-        # rospy.loginfo('maxids: %s' % maxids)
+        # argmax on the flat view; unravel by hand to skip np.unravel_index
+        max_idx = int(self.beliefRV.argmax())
+        max_i = max_idx // self._ncols # phi row
+        max_j = max_idx - max_i*self._ncols # d column
         self.lanePose.header.stamp = segment_list_msg.header.stamp
-        self.lanePose.d = self.d_min + maxids[0]*self.delta_d
-        self.lanePose.phi = self.phi_min + maxids[1]*self.delta_phi
+        self.lanePose.d = self.d_min + max_j*self.delta_d
+        self.lanePose.phi = self.phi_min + max_i*self.delta_phi
         self.lanePose.status = self.lanePose.NORMAL
 
-        # publish the belief image
-        bridge = CvBridge()
-        belief_img = bridge.cv2_to_imgmsg((255*self.beliefRV).astype('uint8'), "mono8")
-        belief_img.header.stamp = segment_list_msg.header.stamp
-        
         max_val = self.beliefRV.max()
-        self.lanePose.in_lane = max_val > self.min_max and len(segment_list_msg.segments) > self.min_segs and np.linalg.norm(measurement_likelihood) != 0
+        self.lanePose.in_lane = max_val > self.min_max and len(segment_list_msg.segments) > self.min_segs and total != 0
         self.pub_lane_pose.publish(self.lanePose)
-        self.pub_belief_img.publish(belief_img)
+
+        # publish the belief image only when a debug subscriber is attached;
+        # hand the raw buffer to the publisher thread and drop the frame if
+        # the previous one is still being encoded
+        if self.pub_belief_img.get_num_connections() > 0:
+            # rows are phi, columns are d (same layout as the belief grid)
+            belief_buf = (255*self.beliefRV).astype('uint8')
+            try:
+                self._img_q.put_nowait((belief_buf, segment_list_msg.header.stamp))
+            except Queue.Full:
+                pass
 
         # print "time to process segments:"
         # print rospy.get_time() - t_start
@@ -324,6 +328,17 @@ For more info on algorithm and parameters please refer to the google doc:
         #     in_lane_msg.data = False
         self.pub_in_lane.publish(in_lane_msg)
 
+    def _img_pub_loop(self):
+        # consumes the raw belief buffers queued by processSegments
+        while not rospy.is_shutdown():
+            try:
+                belief_buf, stamp = self._img_q.get(True, 0.5)
+            except Queue.Empty:
+                continue
+            belief_img = self.bridge.cv2_to_imgmsg(belief_buf, "mono8")
+            belief_img.header.stamp = stamp
+            self.pub_belief_img.publish(belief_img)
+
     def updateVelocity(self,twist_msg):
         self.v_current = twist_msg.v
         self.w_current = twist_msg.omega
@@ -335,67 +350,85 @@ For more info on algorithm and parameters please refer to the google doc:
         #self.w_last = w_current
 
     def initializeBelief(self):
-        pos = np.empty(self.d.shape + (2,))
-        pos[:,:,0]=self.d
-        pos[:,:,1]=self.phi
-        self.cov_0
-        RV = multivariate_normal(self.mean_0,self.cov_0)
-        self.beliefRV=RV.pdf(pos)
+        # bivariate Gaussian with diagonal covariance, evaluated by
+        # broadcasting the two open-grid vectors (no (N,M,2) pos array)
+        dd = self.d_vec - self.mean_0[0]
+        pp = self.phi_vec - self.mean_0[1]
+        logp = -0.5*(dd*dd/self.cov_0[0][0] + pp*pp/self.cov_0[1][1])
+        self.beliefRV = np.exp(logp)
+        self.beliefRV = self.beliefRV/np.sum(self.beliefRV)
 
     def propagateBelief(self):
         delta_t = rospy.get_time() - self.t_last_update
 
-        d_t = self.d + self.v_current*delta_t*np.sin(self.phi)
-        phi_t = self.phi + self.w_current*delta_t
-
-        p_beliefRV = np.zeros(self.beliefRV.shape)
-
-        for i in range(self.beliefRV.shape[0]):
-            for j in range(self.beliefRV.shape[1]):
-                if self.beliefRV[i,j] > 0:
-                    if d_t[i,j] > self.d_max or d_t[i,j] < self.d_min or phi_t[i,j] < self.phi_min or phi_t[i,j] > self.phi_max:
-                        continue
-                    i_new = floor((d_t[i,j] - self.d_min)/self.delta_d)
-                    j_new = floor((phi_t[i,j] - self.phi_min)/self.delta_phi)
-                    p_beliefRV[i_new,j_new] += self.beliefRV[i,j]
-
-        s_beliefRV = np.zeros(self.beliefRV.shape)
-        gaussian_filter(100*p_beliefRV, self.cov_mask, output=s_beliefRV, mode='constant')
-
-        if np.sum(s_beliefRV) == 0:
+        d_t = self.d_vec + self.v_current*delta_t*np.sin(self.phi_vec) # broadcasts to the full grid
+        phi_t = self.phi_vec + self.w_current*delta_t # stays (M,1): phi update is independent of d
+
+        p_beliefRV = np.zeros(self.beliefRV.shape, dtype=np.float32)
+
+        # vectorized scatter: mask the cells that stay on the grid and carry
+        # probability mass, then accumulate them all with one np.add.at call
+        valid = (self.beliefRV > 0) & (d_t >= self.d_min) & (d_t <= self.d_max) \
+                & (phi_t >= self.phi_min) & (phi_t <= self.phi_max)
+        i_new = np.floor((phi_t - self.phi_min)*self._inv_dp).astype(np.intp)
+        i_new = np.broadcast_to(i_new, self.shape) # phi_t is (M,1)
+        j_new = np.floor((d_t - self.d_min)*self._inv_dd).astype(np.intp)
+
+        # scatter tile by tile: the destinations of one 32x32 source block
+        # span only a few cache lines, so the random writes stay hot in L1
+        # instead of sweeping the whole grid per np.add.at call
+        for ti in range(0, self.shape[0], 32):
+            for tj in range(0, self.shape[1], 32):
+                m = valid[ti:ti+32, tj:tj+32]
+                np.add.at(p_beliefRV,
+                          (i_new[ti:ti+32, tj:tj+32][m], j_new[ti:ti+32, tj:tj+32][m]),
+                          self.beliefRV[ti:ti+32, tj:tj+32][m])
+
+        # separable smoothing, in place: two 1-D passes instead of one 2-D
+        # call on a scaled copy (the old 100x scale canceled in the
+        # normalization below anyway)
+        gaussian_filter1d(p_beliefRV, self.cov_mask[1], axis=0, output=p_beliefRV, mode='constant')
+        gaussian_filter1d(p_beliefRV, self.cov_mask[0], axis=1, output=p_beliefRV, mode='constant')
+
+        if np.sum(p_beliefRV) == 0:
             return
-        self.beliefRV = s_beliefRV/np.sum(s_beliefRV)
+        self.beliefRV = p_beliefRV/np.sum(p_beliefRV)
 
-    	#bridge = CvBridge()
-        #prop_img = bridge.cv2_to_imgmsg((255*self.beliefRV).astype('uint8'), "mono8")
-        #self.pub_prop_img.publish(prop_img)
+        #if self.pub_prop_img.get_num_connections() > 0:
+        #    prop_img = self.bridge.cv2_to_imgmsg((255*self.beliefRV).astype('uint8'), "mono8")
+        #    self.pub_prop_img.publish(prop_img)
                 
         return
 
     def updateBelief(self,measurement_likelihood):
-        self.beliefRV=np.multiply(self.beliefRV+1,measurement_likelihood+1)-1
-        self.beliefRV=self.beliefRV/np.sum(self.beliefRV)#np.linalg.norm(self.beliefRV)
+        # (belief+1)*(likelihood+1)-1, fused in place: one temporary for the
+        # shifted likelihood instead of four full-grid intermediates
+        np.add(self.beliefRV, 1.0, out=self.beliefRV)
+        self.beliefRV *= measurement_likelihood + 1.0
+        self.beliefRV -= 1.0
+        self.beliefRV *= 1.0/np.sum(self.beliefRV)
 
     def generateVote(self,segment):
-        p1 = np.array([segment.points[0].x, segment.points[0].y])
-        p2 = np.array([segment.points[1].x, segment.points[1].y])
-        t_hat = (p2-p1)/np.linalg.norm(p2-p1)
-        n_hat = np.array([-t_hat[1],t_hat[0]])
-        d1 = np.inner(n_hat,p1)
-        d2 = np.inner(n_hat,p2)
-        l1 = np.inner(t_hat,p1)
-        l2 = np.inner(t_hat,p2)
-        if (l1 < 0):
-            l1 = -l1;
-        if (l2 < 0):
-            l2 = -l2;
-        l_i = (l1+l2)/2
-        d_i = (d1+d2)/2
-        phi_i = np.arcsin(t_hat[1])
+        # plain scalar math: building length-2 arrays and calling
+        # np.linalg.norm/np.inner per segment costs more than the vote itself
+        x1 = segment.points[0].x
+        y1 = segment.points[0].y
+        x2 = segment.points[1].x
+        y2 = segment.points[1].y
+        dx = x2-x1
+        dy = y2-y1
+        inv = 1.0/sqrt(dx*dx+dy*dy)
+        tx = dx*inv
+        ty = dy*inv
+        nx = -ty
+        ny = tx
+        d_i = (nx*x1+ny*y1 + nx*x2+ny*y2)/2
+        l_i = (abs(tx*x1+ty*y1) + abs(tx*x2+ty*y2))/2
+        phi_i = asin(ty)
         if segment.color == segment.WHITE: # right lane is white
             print 'skip white'
-	    
-	 #   if(p1[0] > p2[0]): # right edge of white lane
+
+	 #   if(x1 > x2): # right edge of white lane
          #       d_i = d_i - self.linewidth_white
          #   else: # left edge of white lane
          #       d_i = - d_i
@@ -403,7 +436,7 @@ For more info on algorithm and parameters please refer to the google doc:
          #   d_i = d_i - self.lanewidth/2
 
         elif segment.color == segment.YELLOW: # left lane is yellow
-            if (p2[0] > p1[0]): # left edge of yellow lane
+            if (x2 > x1): # left edge of yellow lane
                 d_i = d_i - self.linewidth_yellow
                 phi_i = -phi_i
                # print 'left edge of yellow'